@@ -1,15 +1,21 @@
-import json
+import asyncio
 import logging
 import os
 import random
+import sys
 import time
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import Dict, Any
 
+import numpy as np
+import orjson
 import uvicorn
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+from fastapi.responses import ORJSONResponse
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
+)
 from starlette.responses import Response
 
 from opentelemetry import trace
@@ -18,82 +24,208 @@ from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 from opentelemetry.sdk.resources import Resource
 
+# uvicorn importa "main:app" en cada worker; reutilizar este módulo cuando se
+# ejecuta como script evita registrar dos veces las métricas de Prometheus
+sys.modules.setdefault("main", sys.modules[__name__])
+
+def _trace_id_hex(span=None) -> str:
+    """Devuelve el trace_id en hexadecimal del span dado (o el actual).
+
+    Solo se expone si la traza fue muestreada, para que siempre exista en Tempo.
+    """
+    ctx = (span or trace.get_current_span()).get_span_context()
+    if ctx.is_valid and ctx.trace_flags.sampled:
+        return format(ctx.trace_id, "032x")
+    return ""
+
+_LEVEL_LC = {
+    logging.DEBUG: "debug",
+    logging.INFO: "info",
+    logging.WARNING: "warning",
+    logging.ERROR: "error",
+}
+
 # Configurar logging estructurado
 class JSONFormatter(logging.Formatter):
     def format(self, record):
         log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "level": record.levelname.lower(),
+            # Reutiliza record.created; orjson lo serializa en ISO 8601
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc),
+            "level": _LEVEL_LC.get(record.levelno) or record.levelname.lower(),
             "service": "app2",
             "message": record.getMessage(),
         }
         
         # Agregar trace_id si está disponible
-        span = trace.get_current_span()
-        if span.get_span_context().is_valid:
-            log_entry["trace_id"] = format(span.get_span_context().trace_id, "032x")
+        trace_id = _trace_id_hex()
+        if trace_id:
+            log_entry["trace_id"] = trace_id
         
-        return json.dumps(log_entry)
+        return orjson.dumps(log_entry).decode()
 
 # Configurar logger
 logger = logging.getLogger()
 handler = logging.StreamHandler()
 handler.setFormatter(JSONFormatter())
 logger.addHandler(handler)
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+# Generador aleatorio vectorizado para las simulaciones
+rng = np.random.default_rng()
+
+# Métricas Prometheus (registro propio, sin los collectors de proceso/plataforma)
+registry = CollectorRegistry()
 
-# Métricas Prometheus
 http_requests_total = Counter(
     'http_requests_total',
     'Total HTTP requests',
-    ['method', 'endpoint', 'status_code']
+    ['method', 'endpoint', 'status_code'],
+    registry=registry
 )
 
 http_request_duration_seconds = Histogram(
     'http_request_duration_seconds',
     'HTTP request duration in seconds',
-    ['method', 'endpoint']
+    ['method', 'endpoint'],
+    registry=registry
 )
 
 app2_business_metric = Gauge(
     'app2_business_metric',
     'Business metrics for app2',
-    ['type']
+    ['type'],
+    registry=registry
 )
 
 app2_errors_total = Counter(
     'app2_errors_total',
     'Total errors in app2',
-    ['type']
+    ['type'],
+    registry=registry
 )
 
+otel_spans_dropped_total = Counter(
+    'otel_spans_dropped_total',
+    'Total spans dropped because the span processor queue was full',
+    registry=registry
+)
+
+# Hijos pre-enlazados para las rutas y tipos conocidos: evita resolver
+# .labels(...) en cada request
+ENDPOINTS = ("/health", "/api/data", "/api/compute", "/api/database", "/metrics")
+ALLOWED_ENDPOINTS = frozenset(ENDPOINTS)
+OTHER_ENDPOINT = "__other__"
+
+REQ_COUNTERS = {
+    (method, path, status_code): http_requests_total.labels(method, path, status_code)
+    for method in ("GET",)
+    for path in ENDPOINTS
+    for status_code in (200, 500, 503)
+}
+
+REQ_DURATIONS = {
+    (method, path): http_request_duration_seconds.labels(method, path)
+    for method in ("GET",)
+    for path in ENDPOINTS
+    if path != "/metrics"
+}
+
+health_checks_metric = app2_business_metric.labels(type="health_checks")
+data_processed_metric = app2_business_metric.labels(type="data_processed")
+compute_tasks_metric = app2_business_metric.labels(type="compute_tasks")
+db_operations_metric = app2_business_metric.labels(type="db_operations")
+cpu_usage_metric = app2_business_metric.labels(type="cpu_usage")
+memory_usage_metric = app2_business_metric.labels(type="memory_usage")
+active_sessions_metric = app2_business_metric.labels(type="active_sessions")
+
+processing_errors = app2_errors_total.labels(type="processing")
+database_errors = app2_errors_total.labels(type="database")
+background_errors = app2_errors_total.labels(type="background")
+
 # Configurar OpenTelemetry
+class CountingBatchSpanProcessor(BatchSpanProcessor):
+    """BatchSpanProcessor que contabiliza los spans descartados por cola llena.
+
+    queue, max_queue_size y done son internos del SDK (presentes en 1.21.0);
+    si una versión posterior no los expone, simplemente no se contabiliza.
+    """
+    
+    def on_end(self, span):
+        queue = getattr(self, "queue", None)
+        max_queue_size = getattr(self, "max_queue_size", None)
+        if (
+            queue is not None
+            and max_queue_size is not None
+            and not getattr(self, "done", False)
+            and span.context.trace_flags.sampled
+            and len(queue) >= max_queue_size
+        ):
+            otel_spans_dropped_total.inc()
+        super().on_end(span)
+
 def setup_tracing():
     tempo_endpoint = os.getenv("TEMPO_ENDPOINT", "http://tempo:4318/v1/traces")
     
     resource = Resource.create({"service.name": "app2", "service.version": "1.0.0"})
     
-    tracer_provider = TracerProvider(resource=resource)
+    # Muestreo head-based: solo se exporta una fracción de las trazas raíz
+    sampler = ParentBased(
+        TraceIdRatioBased(float(os.getenv("OTEL_TRACES_SAMPLER_ARG", "0.1")))
+    )
+    
+    tracer_provider = TracerProvider(resource=resource, sampler=sampler)
     trace.set_tracer_provider(tracer_provider)
     
-    otlp_exporter = OTLPSpanExporter(endpoint=tempo_endpoint)
-    span_processor = BatchSpanProcessor(otlp_exporter)
+    # Con un collector local (p.ej. unix:///var/run/otel.sock) se exporta por
+    # gRPC sobre un socket Unix, sin pasar por la pila TCP. La importación es
+    # local para no cargar grpcio cuando se usa el exporter HTTP
+    if tempo_endpoint.startswith("unix://"):
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import (
+            OTLPSpanExporter as GRPCSpanExporter
+        )
+        otlp_exporter = GRPCSpanExporter(endpoint=tempo_endpoint, insecure=True)
+    else:
+        otlp_exporter = OTLPSpanExporter(endpoint=tempo_endpoint)
+    
+    # Cola amplia y lotes pequeños para absorber las ráfagas sin perder spans
+    span_processor = CountingBatchSpanProcessor(
+        otlp_exporter,
+        max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "4096")),
+        schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000")),
+        max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "256")),
+        export_timeout_millis=int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "10000"))
+    )
     tracer_provider.add_span_processor(span_processor)
     
     return tracer_provider
 
+# Cada worker de uvicorn inicializa su propio tracer provider y simulador
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tracer_provider = setup_tracing()
+    
+    metrics_task = asyncio.create_task(metrics_simulator())
+    
+    yield
+    
+    metrics_task.cancel()
+    tracer_provider.shutdown()
+
 # Configurar FastAPI
 app = FastAPI(
     title="App2 - Monitoring Lab",
     description="Python FastAPI application with observability",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# Configurar instrumentación
-tracer_provider = setup_tracing()
-FastAPIInstrumentor.instrument_app(app, tracer_provider=tracer_provider)
+# Configurar instrumentación (usa el tracer provider global configurado en lifespan).
+# /health y /metrics no aportan valor diagnóstico, así que no generan spans
+FastAPIInstrumentor.instrument_app(app, excluded_urls="/health,/metrics")
 RequestsInstrumentor().instrument()
 
 tracer = trace.get_tracer(__name__)
@@ -101,74 +233,88 @@ tracer = trace.get_tracer(__name__)
 # Middleware para métricas
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
-    start_time = time.time()
+    # Reloj monotónico: inmune a ajustes de NTP y sin duraciones negativas
+    start_ns = time.monotonic_ns()
     
     response = await call_next(request)
     
-    duration = time.time() - start_time
+    duration = (time.monotonic_ns() - start_ns) / 1e9
+    
+    # Usar la plantilla de la ruta para acotar la cardinalidad del label endpoint
+    endpoint = getattr(request.scope.get("route"), "path", OTHER_ENDPOINT)
+    if endpoint not in ALLOWED_ENDPOINTS:
+        endpoint = OTHER_ENDPOINT
     
     # Actualizar métricas
-    http_requests_total.labels(
-        method=request.method,
-        endpoint=request.url.path,
-        status_code=response.status_code
-    ).inc()
+    counter_key = (request.method, endpoint, response.status_code)
+    counter = REQ_COUNTERS.get(counter_key) or http_requests_total.labels(*counter_key)
+    counter.inc()
     
-    http_request_duration_seconds.labels(
-        method=request.method,
-        endpoint=request.url.path
-    ).observe(duration)
+    # No observar la latencia del propio scrape de Prometheus
+    if endpoint != "/metrics":
+        duration_key = counter_key[:2]
+        histogram = REQ_DURATIONS.get(duration_key) or http_request_duration_seconds.labels(*duration_key)
+        histogram.observe(duration)
     
     return response
 
+# Los scrapes muy seguidos reutilizan la última exposición renderizada
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "1"))
+_metrics_cache = {"expires_at": 0.0, "payload": b""}
+
 @app.get("/metrics")
 async def metrics():
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    now = time.monotonic()
+    if now >= _metrics_cache["expires_at"]:
+        _metrics_cache["payload"] = generate_latest(registry)
+        _metrics_cache["expires_at"] = now + METRICS_CACHE_TTL
+    
+    return Response(_metrics_cache["payload"], media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/health")
 async def health_check():
     logger.info("Health check requested")
     
-    span = trace.get_current_span()
-    trace_id = format(span.get_span_context().trace_id, "032x")
+    trace_id = _trace_id_hex()
     
-    app2_business_metric.labels(type="health_checks").inc()
+    health_checks_metric.inc()
     
     return {
         "message": "App2 is healthy",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
         "trace_id": trace_id
     }
 
 @app.get("/api/data")
 async def get_data():
     with tracer.start_as_current_span("process_data") as span:
+        trace_id = _trace_id_hex(span)
+        
         logger.info("Processing data request")
         
         # Simular procesamiento
         processing_time = random.uniform(0.1, 0.5)
-        time.sleep(processing_time)
+        await asyncio.sleep(processing_time)
         
         span.set_attribute("processing.duration", processing_time)
         
         # Simular errores ocasionales
         if random.random() < 0.15:
             logger.error("Random error occurred during data processing")
-            app2_errors_total.labels(type="processing").inc()
+            processing_errors.inc()
             raise HTTPException(status_code=500, detail="Internal processing error")
         
         # Simular llamada externa
         with tracer.start_as_current_span("external_call") as external_span:
             external_time = random.uniform(0.05, 0.2)
-            time.sleep(external_time)
+            await asyncio.sleep(external_time)
             external_span.set_attribute("external.duration", external_time)
         
-        trace_id = format(span.get_span_context().trace_id, "032x")
-        app2_business_metric.labels(type="data_processed").inc()
+        data_processed_metric.inc()
         
         return {
             "message": "Data processed successfully",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "trace_id": trace_id,
             "processing_time": processing_time
         }
@@ -176,6 +322,8 @@ async def get_data():
 @app.get("/api/compute")
 async def compute_task():
     with tracer.start_as_current_span("compute_task") as span:
+        trace_id = _trace_id_hex(span)
+        
         logger.info("Compute task started")
         
         # Simular tarea computacional intensiva
@@ -185,19 +333,17 @@ async def compute_task():
         span.set_attribute("compute.iterations", iterations)
         span.set_attribute("compute.duration", compute_time)
         
-        # Simular trabajo
-        result = 0
-        for i in range(iterations):
-            result += random.random()
-            if i % 1000 == 0:
-                time.sleep(compute_time / (iterations / 1000))
+        # Simular trabajo en bloques vectorizados de 1000 iteraciones
+        result = 0.0
+        for start in range(0, iterations, 1000):
+            result += float(rng.random(min(1000, iterations - start)).sum())
+            await asyncio.sleep(compute_time / (iterations / 1000))
         
-        trace_id = format(span.get_span_context().trace_id, "032x")
-        app2_business_metric.labels(type="compute_tasks").inc()
+        compute_tasks_metric.inc()
         
         return {
             "message": "Compute task completed",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "trace_id": trace_id,
             "result": round(result, 2),
             "iterations": iterations
@@ -206,63 +352,64 @@ async def compute_task():
 @app.get("/api/database")
 async def database_operation():
     with tracer.start_as_current_span("database_operation") as span:
+        trace_id = _trace_id_hex(span)
+        
         logger.info("Database operation started")
         
         # Simular operación de base de datos
         db_time = random.uniform(0.2, 1.0)
         
         with tracer.start_as_current_span("db_connect") as connect_span:
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             connect_span.set_attribute("db.connection", "postgresql")
         
         with tracer.start_as_current_span("db_query") as query_span:
             query_span.set_attribute("db.statement", "SELECT * FROM users WHERE active = true")
             query_span.set_attribute("db.rows_affected", random.randint(10, 100))
-            time.sleep(db_time)
+            await asyncio.sleep(db_time)
         
         # Simular error de DB ocasional
         if random.random() < 0.08:
             logger.error("Database connection timeout")
-            app2_errors_total.labels(type="database").inc()
+            database_errors.inc()
             raise HTTPException(status_code=503, detail="Database temporarily unavailable")
         
-        trace_id = format(span.get_span_context().trace_id, "032x")
-        app2_business_metric.labels(type="db_operations").inc()
+        db_operations_metric.inc()
         
         return {
             "message": "Database operation completed",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "trace_id": trace_id,
             "query_time": round(db_time, 3)
         }
 
 # Simulador de métricas en background
-import asyncio
-import threading
-
-def metrics_simulator():
+async def metrics_simulator():
     while True:
-        app2_business_metric.labels(type="cpu_usage").set(random.uniform(10, 90))
-        app2_business_metric.labels(type="memory_usage").set(random.uniform(20, 80))
-        app2_business_metric.labels(type="active_sessions").set(random.randint(5, 50))
+        cpu_usage_metric.set(rng.uniform(10, 90))
+        memory_usage_metric.set(rng.uniform(20, 80))
+        active_sessions_metric.set(int(rng.integers(5, 51)))
         
-        if random.random() < 0.03:
-            app2_errors_total.labels(type="background").inc()
+        if rng.random() < 0.03:
+            background_errors.inc()
             logger.warning("Background task warning")
         
-        time.sleep(15)
-
-# Iniciar simulador en background
-metrics_thread = threading.Thread(target=metrics_simulator, daemon=True)
-metrics_thread.start()
+        await asyncio.sleep(15)
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    logger.info(f"App2 starting on port {port}")
+    logger.info("App2 starting on port %s", port)
     
     uvicorn.run(
-        app,
+        "main:app",  # Import string requerido para usar múltiples workers
         host="0.0.0.0",
         port=port,
+        loop="uvloop",
+        http="httptools",
+        # Cada worker tiene su propio registro de Prometheus; en el lab se escala
+        # con réplicas y se mantiene un único worker por pod
+        workers=int(os.getenv("WORKERS", "1")),
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
         log_config=None  # Usar nuestro logger personalizado
     )
\ No newline at end of file
@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 
-import json
+import aiohttp
+import asyncio
+import itertools
+import orjson
 import os
 import random
-import requests
+import sys
 import time
-import threading
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import List, Dict
 
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
 class TrafficGenerator:
     def __init__(self):
         self.target_url = os.getenv("TARGET_URL", "http://app2-service:8000")
         self.request_interval = int(os.getenv("REQUEST_INTERVAL", "4"))
         self.error_rate = float(os.getenv("ERROR_RATE", "0.12"))
+        self.log_level = LOG_LEVELS.get(os.getenv("LOG_LEVEL", "info").lower(), LOG_LEVELS["info"])
         
         self.endpoints = [
             {"path": "/health", "weight": 0.3, "method": "GET"},
@@ -21,92 +26,96 @@ class TrafficGenerator:
             {"path": "/api/compute", "weight": 0.2, "method": "GET"},
             {"path": "/api/database", "weight": 0.1, "method": "GET"}
         ]
-        
-        self.session = requests.Session()
-        self.session.timeout = 10
+        self._endpoint_objs = self.endpoints
+        self._cum_weights = list(itertools.accumulate(e["weight"] for e in self.endpoints))
+    
+    def is_enabled(self, level: str) -> bool:
+        return LOG_LEVELS.get(level, 0) >= self.log_level
     
     def log_message(self, level: str, message: str, **kwargs):
+        if not self.is_enabled(level):
+            return
+        
         log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc),
             "level": level,
             "service": "app2-traffic-generator",
             "message": message,
             **kwargs
         }
-        print(json.dumps(log_entry))
+        sys.stdout.buffer.write(orjson.dumps(log_entry) + b"\n")
     
     def select_endpoint(self) -> Dict:
         """Selecciona un endpoint basado en los pesos configurados"""
-        r = random.random()
-        cumulative_weight = 0
-        
-        for endpoint in self.endpoints:
-            cumulative_weight += endpoint["weight"]
-            if r <= cumulative_weight:
-                return endpoint
-        
-        return self.endpoints[0]  # fallback
+        return random.choices(self._endpoint_objs, cum_weights=self._cum_weights, k=1)[0]
     
-    def make_request(self, endpoint: Dict):
+    async def make_request(self, session: aiohttp.ClientSession, endpoint: Dict):
         url = f"{self.target_url}{endpoint['path']}"
         
         try:
             start_time = time.time()
-            response = self.session.request(endpoint["method"], url)
+            async with session.request(endpoint["method"], url) as response:
+                await response.read()
             duration = time.time() - start_time
             
-            status = "success" if response.status_code < 400 else "error"
-            
-            self.log_message(
-                "info",
-                f"Request completed",
-                endpoint=endpoint["path"],
-                method=endpoint["method"],
-                status_code=response.status_code,
-                duration_ms=round(duration * 1000, 2),
-                status=status
-            )
+            if self.is_enabled("info"):
+                self.log_message(
+                    "info",
+                    "Request completed",
+                    endpoint=endpoint["path"],
+                    method=endpoint["method"],
+                    status_code=response.status,
+                    duration_ms=round(duration * 1000, 2),
+                    status="success" if response.status < 400 else "error"
+                )
             
-        except requests.exceptions.RequestException as e:
-            self.log_message(
-                "error",
-                f"Request failed: {str(e)}",
-                endpoint=endpoint["path"],
-                method=endpoint["method"],
-                error_type=type(e).__name__
-            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if self.is_enabled("error"):
+                self.log_message(
+                    "error",
+                    f"Request failed: {str(e) or type(e).__name__}",
+                    endpoint=endpoint["path"],
+                    method=endpoint["method"],
+                    error_type=type(e).__name__
+                )
     
-    def generate_burst_traffic(self):
+    async def generate_burst_traffic(self, session: aiohttp.ClientSession):
         """Genera ráfagas de tráfico para simular picos de carga"""
         while True:
-            # Esperar entre 30-120 segundos para la próxima ráfaga
-            wait_time = random.randint(30, 120)
-            time.sleep(wait_time)
-            
-            # Generar ráfaga de 5-15 requests
-            burst_size = random.randint(5, 15)
-            
-            self.log_message(
-                "info",
-                f"Generating traffic burst",
-                burst_size=burst_size
-            )
-            
-            threads = []
-            for _ in range(burst_size):
-                endpoint = self.select_endpoint()
-                thread = threading.Thread(target=self.make_request, args=(endpoint,))
-                threads.append(thread)
-                thread.start()
+            try:
+                # Esperar entre 30-120 segundos para la próxima ráfaga
+                wait_time = random.randint(30, 120)
+                await asyncio.sleep(wait_time)
                 
-                # Pequeña pausa entre requests de la ráfaga
-                time.sleep(random.uniform(0.1, 0.5))
-            
-            # Esperar que terminen todos los threads
-            for thread in threads:
-                thread.join()
+                # Generar ráfaga de 5-15 requests
+                burst_size = random.randint(5, 15)
+                
+                self.log_message(
+                    "info",
+                    "Generating traffic burst",
+                    burst_size=burst_size
+                )
+                
+                # Todas las requests se programan a la vez con un pequeño desfase
+                # (0-0.5s) en lugar de lanzarse con pausas en serie
+                offsets = sorted(random.uniform(0, 0.5) for _ in range(burst_size))
+                await asyncio.gather(*(
+                    self._delayed_call(session, offset) for offset in offsets
+                ))
+                
+            except Exception as e:
+                self.log_message(
+                    "error",
+                    f"Unexpected error in burst traffic: {str(e)}",
+                    error_type=type(e).__name__
+                )
+                await asyncio.sleep(5)  # Breve pausa antes de continuar
+    
+    async def _delayed_call(self, session: aiohttp.ClientSession, offset: float):
+        await asyncio.sleep(offset)
+        await self.make_request(session, self.select_endpoint())
     
-    def generate_regular_traffic(self):
+    async def generate_regular_traffic(self, session: aiohttp.ClientSession):
         """Genera tráfico regular y constante"""
         self.log_message(
             "info",
@@ -120,46 +129,49 @@ class TrafficGenerator:
                 # Número de requests simultáneos (1-3)
                 concurrent_requests = random.randint(1, 3)
                 
-                threads = []
-                for _ in range(concurrent_requests):
-                    endpoint = self.select_endpoint()
-                    thread = threading.Thread(target=self.make_request, args=(endpoint,))
-                    threads.append(thread)
-                    thread.start()
-                    
-                    # Pausa muy pequeña entre iniciar threads
-                    if concurrent_requests > 1:
-                        time.sleep(random.uniform(0.1, 0.3))
-                
-                # Esperar que terminen
-                for thread in threads:
-                    thread.join()
+                await asyncio.gather(*[
+                    self.make_request(session, self.select_endpoint())
+                    for _ in range(concurrent_requests)
+                ])
                 
                 # Esperar hasta el próximo ciclo
                 base_interval = self.request_interval
                 jitter = random.uniform(-1, 1)  # ±1 segundo de jitter
                 sleep_time = max(1, base_interval + jitter)
-                time.sleep(sleep_time)
+                await asyncio.sleep(sleep_time)
                 
-            except KeyboardInterrupt:
-                self.log_message("info", "Traffic generator stopping")
-                break
             except Exception as e:
                 self.log_message(
                     "error",
                     f"Unexpected error in traffic generator: {str(e)}",
                     error_type=type(e).__name__
                 )
-                time.sleep(5)  # Breve pausa antes de continuar
+                await asyncio.sleep(5)  # Breve pausa antes de continuar
     
-    def run(self):
-        """Ejecuta ambos generadores de tráfico en paralelo"""
-        # Iniciar el generador de ráfagas en un thread separado
-        burst_thread = threading.Thread(target=self.generate_burst_traffic, daemon=True)
-        burst_thread.start()
+    async def run_async(self):
+        """Ejecuta ambos generadores de tráfico sobre un único event loop"""
+        # Pool compartido con keep-alive: las ráfagas reutilizan conexiones abiertas.
+        # El keep-alive del cliente queda por debajo del de uvicorn (30s) para no
+        # reutilizar sockets que el servidor ya cerró
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=64,
+            keepalive_timeout=25,
+            ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(total=10)
         
-        # Ejecutar el tráfico regular en el thread principal
-        self.generate_regular_traffic()
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(
+                self.generate_regular_traffic(session),
+                self.generate_burst_traffic(session)
+            )
+    
+    def run(self):
+        try:
+            asyncio.run(self.run_async())
+        except KeyboardInterrupt:
+            self.log_message("info", "Traffic generator stopping")
 
 if __name__ == "__main__":
     generator = TrafficGenerator()